@@ -0,0 +1,196 @@
+"""
+Copyright (C) 2017 Planview, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import contextlib
+import inspect
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+# How long to wait before polling for a free concurrency slot, or a lock
+# where the platform has no blocking lock, again
+SLOT_POLL_INTERVAL = 0.05
+
+
+def _lock(fd, blocking=True):
+    """
+    Take an exclusive lock on an open file, shared by all processes.
+
+    :param fd: file descriptor
+    :param blocking: wait for the lock if it is taken
+    :return: None, raises IOError if non-blocking and the lock is taken
+    """
+    if fcntl:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        fcntl.flock(fd, flags)
+        return
+    while True:
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            # LK_LOCK gives up after about ten seconds, so poll instead
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return
+        except (IOError, OSError):
+            if not blocking:
+                raise
+        time.sleep(SLOT_POLL_INTERVAL)
+
+
+def _unlock(fd):
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def parse_limits(lines, convert):
+    """
+    Parse ini lines of the form '<class name>: <value>'.
+
+    :param lines: list of ini lines
+    :param convert: type of the value, e.g. int or float
+    :return: dict of class name and value
+    """
+    limits = {}
+    for line in lines:
+        name, sep, value = line.partition(':')
+        try:
+            if not sep or not name.strip():
+                raise ValueError
+            limit = convert(value.strip())
+            if not limit > 0:
+                raise ValueError
+        except ValueError:
+            raise ValueError(
+                "Invalid creation limit <{}>, expected "
+                "'<class name>: <value>' with a value greater than "
+                "0".format(line))
+        limits[name.strip()] = limit
+    return limits
+
+
+class CreationBudget(object):
+    """
+    Limits the rate and concurrency of object creation per representation
+    class.
+
+    State is kept in lock files in a directory, so all processes using the
+    same directory (e.g. xdist workers) share the budget.
+
+    Limits for a class are looked up by the class name, then the names of
+    its bases and last '*', which applies to all classes.
+    """
+
+    def __init__(self, directory, rates=None, concurrency=None):
+        """
+        :param directory: directory holding the shared state
+        :param rates: dict of class name and creations per second
+        :param concurrency: dict of class name and max simultaneous
+                            creations
+        """
+        self.directory = directory
+        self.rates = rates or {}
+        self.concurrency = concurrency or {}
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another worker got there first
+                if not os.path.isdir(directory):
+                    raise
+
+    def _lookup(self, limits, cls):
+        for category in inspect.getmro(cls):
+            if category.__name__ in limits:
+                return category.__name__, limits[category.__name__]
+        if '*' in limits:
+            return '_all', limits['*']
+        return None, None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextlib.contextmanager
+    def acquire(self, cls):
+        """
+        Wait until the budget allows creating an object of the given class
+        and hold a concurrency slot for the duration of the block.
+
+        :param cls: representation class to create
+        """
+        self._take_token(cls)
+        fd = self._take_slot(cls)
+        try:
+            yield
+        finally:
+            if fd is not None:
+                _unlock(fd)
+                os.close(fd)
+
+    def _take_token(self, cls):
+        name, rate = self._lookup(self.rates, cls)
+        if not rate:
+            return
+        burst = max(1.0, rate)
+        fd = os.open(self._path(name + '.bucket'), os.O_RDWR | os.O_CREAT)
+        try:
+            while True:
+                _lock(fd)
+                try:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    raw = os.read(fd, 1024)
+                    now = time.time()
+                    try:
+                        state = json.loads(raw.decode('utf-8'))
+                        tokens = min(burst, state['tokens'] +
+                                     (now - state['stamp']) * rate)
+                    except (ValueError, KeyError, TypeError):
+                        tokens = burst
+                    wait = 0 if tokens >= 1 else (1 - tokens) / rate
+                    if not wait:
+                        tokens -= 1
+                    raw = json.dumps({'tokens': tokens, 'stamp': now})
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.ftruncate(fd, 0)
+                    os.write(fd, raw.encode('utf-8'))
+                finally:
+                    _unlock(fd)
+                if not wait:
+                    return
+                time.sleep(wait)
+        finally:
+            os.close(fd)
+
+    def _take_slot(self, cls):
+        name, limit = self._lookup(self.concurrency, cls)
+        if not limit:
+            return None
+        while True:
+            for index in range(limit):
+                path = self._path('{}.slot{}'.format(name, index))
+                fd = os.open(path, os.O_RDWR | os.O_CREAT)
+                try:
+                    _lock(fd, blocking=False)
+                except (IOError, OSError):
+                    os.close(fd)
+                    continue
+                # The lock is released by the OS should the process die
+                return fd
+            time.sleep(SLOT_POLL_INTERVAL)
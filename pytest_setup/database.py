@@ -10,48 +10,134 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import inspect
+import time
+
 from pytest_setup import basestring
 
 
+class TestDataRecord(object):
+    """
+    Plugin metadata of an object in the TestDataCollection, kept apart so
+    the data representation object itself is left untouched.
+    """
+    __slots__ = ('obj', 'identifier', 'ttl', 'nodeid', 'created',
+                 'categories', 'keys')
+
+    def __init__(self, obj, identifier, ttl, nodeid, categories):
+        """
+        :param obj: data representation object
+        :param identifier: identifier of the object
+        :param ttl: time to live for object
+        :param nodeid: node id of the test or module that created the object
+        :param categories: tuple of category names the object is stored under
+        """
+        self.obj = obj
+        self.identifier = identifier
+        self.ttl = ttl
+        self.nodeid = nodeid
+        self.created = time.time()
+        self.categories = categories
+        self.keys = []
+
+
 class TestDataCollection(object):
     """
     Collection to hold all the data representation objects.
 
     DB model:
     db = {'User': {'kalle': <object>}}
+
+    The metadata of every object is kept in a record, by object id:
+    records = {id(<object>): <TestDataRecord>}
+
+    Objects added with a key, identifying the request they were created
+    from, can be found again with that key:
+    requests = {('User', (('name', 'kalle'),)): <object>}
     """
     db = {}
+    records = {}
+    requests = {}
 
-    def __init__(self, base_repr):
+    def __init__(self, base_repr, shared=True):
         """
         :param base_repr: The base representation class of
                             which all other representations are based on
+        :param shared: If False, the collection gets a DB of its own instead
+                        of the one shared by all collections
         """
         self.base_repr = base_repr
+        if not shared:
+            self.db = {}
+            self.records = {}
+            self.requests = {}
 
-    def add(self, obj, ttl='module'):
+    def add(self, obj, ttl='module', key=None, nodeid=None):
         """
         Add data representation object to the collection.
 
         :param obj: data representation object
         :param ttl: time to live for object (default: function)
+        :param key: hashable key of the request the object was created from,
+                    a tuple starting with the category name
+        :param nodeid: node id of the test or module creating the object
         :return: the object added
         """
-        import inspect
+        identifier = obj.identifier
+        categories = tuple(category.__name__
+                           for category in inspect.getmro(type(obj))
+                           if category not in (self.base_repr, object))
 
-        for category in inspect.getmro(type(obj)):
-            if category in (self.base_repr, object):
-                continue
-
-            category_db = self.db.setdefault(category.__name__, {})
-            if obj.identifier in category_db:
+        for category in categories:
+            if identifier in self.db.get(category, {}):
                 raise KeyError(
                     "Duplicate identifier <{}> in category <{}> for object "
-                    "<{}>".format(obj.identifier, category.__name__, obj))
-            category_db[obj.identifier] = obj
-        obj.ttl = ttl
+                    "<{}>".format(identifier, category, obj))
+        for category in categories:
+            self.db.setdefault(category, {})[identifier] = obj
+
+        self.records[id(obj)] = TestDataRecord(obj, identifier, ttl, nodeid,
+                                               categories)
+        self._add_key(key, obj)
         return obj
 
+    def _add_key(self, key, obj):
+        if key is not None:
+            self.requests[key] = obj
+            self.records[id(obj)].keys.append(key)
+
+    def merge(self, other, ttl=None, nodeid=None):
+        """
+        Add the objects of another collection, keeping their metadata.
+
+        :param other: TestDataCollection to add the objects of
+        :param ttl: If set, only objects with specified ttl are added
+        :param nodeid: node id to set on objects that have none
+        :return: list of the objects added
+        """
+        added = []
+        for record in list(other.records.values()):
+            if ttl and record.ttl != ttl:
+                continue
+            self.add(record.obj, record.ttl,
+                     nodeid=record.nodeid or nodeid)
+            self.records[id(record.obj)].created = record.created
+            for key in record.keys:
+                self._add_key(key, record.obj)
+            added.append(record.obj)
+        return added
+
+    def find(self, key):
+        """
+        Find the data representation object created from a request.
+
+        :param key: hashable key of the request, as given to add
+        :return: data representation object, or None if not in the DB
+        """
+        if key is None:
+            return None
+        return self.requests.get(key, None)
+
     def get(self, category, identifier):
         """
         Get data representation object from the collection.
@@ -65,22 +151,43 @@ class TestDataCollection(object):
         category_db = self.db.get(category, {})
         return category_db.get(identifier, None)
 
+    def record(self, obj):
+        """
+        Get the metadata of a data representation object in the collection.
+
+        :param obj: data representation object
+        :return: TestDataRecord, or None if the object is not in the DB
+        """
+        record = self.records.get(id(obj), None)
+        if record is None or record.obj is not obj:
+            return None
+        return record
+
     def clear(self, ttl=None):
         """
         Clear the DB and all its references.
 
         :param ttl: If set, db will only be cleared from objects with
         specified ttl
-        :return: None
+        :return: number of objects removed
         """
-        if ttl:
-            for category in self.categories:
-                current = self.db[category]
-                for identifier in list(current.keys()):
-                    if current[identifier].ttl == ttl:
-                        del current[identifier]
-        else:
+        if not ttl:
+            removed = len(self.records)
             self.db.clear()
+            self.records.clear()
+            self.requests.clear()
+            return removed
+
+        removed = [record for record in self.records.values()
+                   if record.ttl == ttl]
+        for record in removed:
+            for category in record.categories:
+                del self.db[category][record.identifier]
+            for key in record.keys:
+                if self.requests.get(key) is record.obj:
+                    del self.requests[key]
+            del self.records[id(record.obj)]
+        return len(removed)
 
     def dump_db(self):
         """
@@ -91,6 +198,23 @@ class TestDataCollection(object):
         print("DUMPING DB:")
         print(self.db)
 
+    def objects(self, ttl=None):
+        """
+        Return all objects in the DB, each object once no matter how many
+        categories it is in.
+
+        :param ttl: If set, only objects with specified ttl are returned
+        :return: list of data representation objects
+        """
+        return [record.obj for record in self.records.values()
+                if not ttl or record.ttl == ttl]
+
+    def __len__(self):
+        """
+        Return the number of objects in the DB.
+        """
+        return len(self.records)
+
     @property
     def categories(self):
         """
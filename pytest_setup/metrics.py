@@ -0,0 +1,98 @@
+"""
+Copyright (C) 2017 Planview, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import contextlib
+import json
+from timeit import default_timer
+
+
+class SetupMetrics(object):
+    """
+    Overhead of the plugin's setup and teardown for a single test item.
+
+    Durations are in seconds.
+    """
+    TIMERS = ('setup_module', 'setup_function', 'user', 'users',
+              'clean_test_db')
+
+    def __init__(self, nodeid):
+        """
+        :param nodeid: node id of the test item
+        """
+        self.nodeid = nodeid
+        self.durations = dict.fromkeys(self.TIMERS, 0.0)
+        self.created = 0
+        self.reused = 0
+        self.cleared = 0
+        self.peak_size = 0
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """
+        Add the time spent in the block to the named duration.
+
+        :param name: one of TIMERS
+        """
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.durations[name] += default_timer() - start
+
+    def record_size(self, size):
+        """
+        Record the current size of the test DB.
+
+        :param size: number of objects in the test DB
+        :return: None
+        """
+        self.peak_size = max(self.peak_size, size)
+
+    def as_properties(self):
+        """
+        Return the metrics as name and value pairs, e.g. for user_properties.
+
+        :return: list of tuples
+        """
+        properties = [('{}_time'.format(name), self.durations[name])
+                      for name in self.TIMERS]
+        properties.extend([('setup_objects_created', self.created),
+                           ('setup_objects_reused', self.reused),
+                           ('setup_objects_cleared', self.cleared),
+                           ('setup_test_db_peak_size', self.peak_size)])
+        return properties
+
+
+class MetricsLog(object):
+    """
+    Writes the metrics of every test item as JSON lines to a file.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the file, appended to if it exists
+        """
+        self._file = open(path, 'a')
+
+    def write(self, metrics):
+        """
+        Write the metrics of a single test item.
+
+        :param metrics: SetupMetrics instance
+        :return: None
+        """
+        record = dict(metrics.as_properties(), nodeid=metrics.nodeid)
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,152 @@
+"""
+Copyright (C) 2017 Planview, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+import sys
+import threading
+
+from pytest_setup import is_py2
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+if is_py2:
+    exec("def _reraise(exc_type, exc_value, exc_tb):\n"
+         "    raise exc_type, exc_value, exc_tb\n")
+else:
+    def _reraise(exc_type, exc_value, exc_tb):
+        raise exc_value.with_traceback(exc_tb)
+
+
+class _PrefetchJob(threading.Thread):
+    """
+    Background thread creating the module level data of a single module.
+    """
+
+    def __init__(self, module, create):
+        super(_PrefetchJob, self).__init__(
+            name="pytest-setup-prefetch-{}".format(module.__name__))
+        self.daemon = True
+        self.module = module
+        self._create = create
+        self.result = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.result = self._create(self.module)
+        except BaseException:
+            self.exc_info = sys.exc_info()
+
+
+class ModulePrefetcher(object):
+    """
+    Creates the module_setup_data of the next module in the background
+    while the tests of the current module run.
+
+    Only one module is prefetched at a time. A module that is passed
+    without being set up, e.g. because all its tests were skipped, has its
+    prefetched data discarded.
+    """
+
+    def __init__(self, order, modules, create):
+        """
+        :param order: all modules, in run order
+        :param modules: modules with module_setup_data to prefetch
+        :param create: callable taking a module, creating its data and
+                        returning the result
+        """
+        self._positions = dict((module, index)
+                               for index, module in enumerate(order))
+        self.modules = [module for module in order if module in modules]
+        self._create = create
+        self._job = None
+        self._current = -1
+
+    def _position(self, module):
+        return self._positions.get(module, self._current)
+
+    def _discard_passed(self):
+        """
+        Discard the job if its module has been passed.
+
+        :return: None
+        """
+        job = self._job
+        if job is None or self._position(job.module) > self._current:
+            return
+        self._job = None
+        job.join()
+        LOGGER.debug("Discarding data prefetched for module {}, which was "
+                     "never set up".format(job.module.__name__))
+
+    def prefetch_after(self, module):
+        """
+        Start prefetching the module following the given module.
+
+        :param module: module currently being set up
+        :return: None
+        """
+        self._current = max(self._current, self._position(module))
+        self._discard_passed()
+        if self._job is not None:
+            return
+        # Modules up to and including the current one have already run
+        self.modules = [each for each in self.modules
+                        if self._position(each) > self._current]
+        if self.modules:
+            self._job = _PrefetchJob(self.modules[0], self._create)
+            self._job.start()
+
+    def take(self, module):
+        """
+        Wait for and return the objects prefetched for the given module.
+
+        Re-raises any error that occurred while prefetching.
+
+        :param module: module being set up
+        :return: result of the creation, or None if the module was not
+                    prefetched
+        """
+        job = self._job
+        if job is None:
+            return None
+        if job.module is not module:
+            if self._position(job.module) < self._position(module):
+                self._current = max(self._current,
+                                    self._position(job.module))
+                self._discard_passed()
+            return None
+        self._job = None
+        job.join()
+        if job.exc_info:
+            _reraise(*job.exc_info)
+        return job.result
+
+    def close(self):
+        """
+        Discard any prefetched data that was never taken.
+
+        A creation already in progress is waited for so that it does not
+        outlive the session.
+
+        :return: None
+        """
+        job, self._job = self._job, None
+        self.modules = []
+        if job is None:
+            return
+        job.join()
+        if job.exc_info is None:
+            LOGGER.debug("Discarding data prefetched for module {}".format(
+                job.module.__name__))
@@ -11,10 +11,12 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import pytest
+import contextlib
 import importlib
 import logging
 import sys
 import re
+import warnings
 
 
 # Syntax sugar.
@@ -70,18 +72,129 @@ def pytest_configure(config):
     # Object data setup marker
     config.addinivalue_line("markers",
                             "setup_data: test data for object creation")
+    config.addinivalue_line("markers",
+                            "recreate_data: recreate function level test "
+                            "data when the test is rerun")
 
+    metrics_log = config.getini('setup_metrics_log')
+    if metrics_log:
+        from . import metrics
 
-def _get_representation(class_name, request):
-    base = request.config.getini('representation_path').lower()
+        config._setup_metrics_log = metrics.MetricsLog(metrics_log)
+
+
+def pytest_unconfigure(config):
+    """
+    py.test hook called before the test process exits.
+
+    :param config: py.test config module
+    :return: None
+    """
+    metrics_log = getattr(config, '_setup_metrics_log', None)
+    if metrics_log:
+        metrics_log.close()
+        config._setup_metrics_log = None
+
+
+def _metrics_enabled(config):
+    return config.getini('setup_metrics') or config.getini('setup_metrics_log')
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_setup(item):
+    """
+    py.test hook wrapping the setup of a test item.
+
+    Starts collecting the setup metrics of the item, if enabled.
+
+    :param item: py.test test item
+    :return: None
+    """
+    item._setup_call_failed = False
+    if _metrics_enabled(item.config):
+        from . import metrics
+
+        item._setup_metrics = metrics.SetupMetrics(item.nodeid)
+        item.config._setup_metrics = item._setup_metrics
+    yield
+    item.config._setup_metrics = None
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_teardown(item):
+    """
+    py.test hook wrapping the teardown of a test item.
+
+    Attaches the setup metrics of the item as user properties and writes
+    them to the metrics log.
+
+    :param item: py.test test item
+    :return: None
+    """
+    item_metrics = getattr(item, '_setup_metrics', None)
+    item.config._setup_metrics = item_metrics
+    yield
+    item.config._setup_metrics = None
+    if item_metrics is None:
+        return
+    # Replace the properties of an earlier attempt when the test is rerun
+    properties = item_metrics.as_properties()
+    names = set(name for name, _ in properties)
+    item.user_properties[:] = [
+        prop for prop in item.user_properties if prop[0] not in names]
+    item.user_properties.extend(properties)
+    metrics_log = getattr(item.config, '_setup_metrics_log', None)
+    if metrics_log:
+        metrics_log.write(item_metrics)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    """
+    py.test hook wrapping the creation of test reports.
+
+    Records whether the test itself failed, as opposed to its setup.
+
+    :param item: py.test test item
+    :param call: call info of the phase
+    :return: None
+    """
+    outcome = yield
+    report = outcome.get_result()
+    if report.when == 'call' and report.failed:
+        item._setup_call_failed = True
+
+
+def _metrics(config):
+    """
+    Return the metrics of the test item currently set up or torn down.
+
+    :param config: py.test config module
+    :return: SetupMetrics instance, or None if metrics are disabled
+    """
+    return getattr(config, '_setup_metrics', None)
+
+
+@contextlib.contextmanager
+def _timed(request, name):
+    item_metrics = _metrics(request.config)
+    if item_metrics is None:
+        yield
+    else:
+        with item_metrics.timed(name):
+            yield
+
+
+def _get_representation(class_name, config):
+    base = config.getini('representation_path').lower()
     module = importlib.import_module(re.sub(r"\\|/", ".", base))
     return getattr(module, class_name)
 
 
-def _get_base_representation(request):
-    base_repr_class_name = request.config.getini('base_repr_class_name')
+def _get_base_representation(config):
+    base_repr_class_name = config.getini('base_repr_class_name')
     if base_repr_class_name:
-        return _get_representation(base_repr_class_name, request)
+        return _get_representation(base_repr_class_name, config)
 
 
 def _get_representation2(class_name, request):
@@ -115,6 +228,162 @@ def pytest_addoption(parser):
                   help='directory for representations')
     parser.addini('base_repr_class_name',
                   help='class name of the base representation')
+    parser.addini('prefetch_module_data', type='bool', default=False,
+                  help='create the next module\'s module_setup_data in '
+                       'the background while the current module runs')
+    parser.addini('setup_metrics', type='bool', default=False,
+                  help='attach the setup overhead of every test to its '
+                       'user properties')
+    parser.addini('setup_metrics_log',
+                  help='file to append the setup overhead of every test to, '
+                       'as JSON lines (implies setup_metrics)')
+    parser.addini('keep_data_on_rerun', type='bool', default=False,
+                  help='keep the function level data of a failed test for '
+                       'its rerun by pytest-rerunfailures or flaky')
+    parser.addini('creation_rate', type='linelist',
+                  help='max creations per second per representation class, '
+                       'one "<class name>: <rate>" per line, "*" for all')
+    parser.addini('creation_concurrency', type='linelist',
+                  help='max simultaneous creations per representation '
+                       'class, one "<class name>: <max>" per line, "*" for '
+                       'all')
+    parser.addini('creation_budget_dir',
+                  help='directory for the creation budget state shared '
+                       'between processes (default: in the temp directory)')
+
+
+def pytest_sessionstart(session):
+    """
+    py.test hook called when the test session starts.
+
+    Sets up the creation budget if any creation limits are configured.
+
+    :param session: py.test session
+    :return: None
+    """
+    from . import budget
+
+    config = session.config
+    try:
+        rates = budget.parse_limits(config.getini('creation_rate'), float)
+        concurrency = budget.parse_limits(
+            config.getini('creation_concurrency'), int)
+    except ValueError as e:
+        raise pytest.UsageError(str(e))
+    if not rates and not concurrency:
+        return
+
+    directory = config.getini('creation_budget_dir')
+    if not directory:
+        import hashlib
+        import os
+        import tempfile
+
+        # Processes running from the same rootdir, e.g. xdist workers,
+        # share the budget
+        rootdir = hashlib.md5(str(config.rootdir).encode('utf-8'))
+        directory = os.path.join(
+            tempfile.gettempdir(),
+            'pytest-setup-budget-{}'.format(rootdir.hexdigest()))
+    config._setup_budget = budget.CreationBudget(directory, rates,
+                                                 concurrency)
+
+
+def pytest_collection_finish(session):
+    """
+    py.test hook called after collection and deselection.
+
+    Sets up the module prefetcher, if enabled, with the modules that are
+    actually going to run, in the order they are going to run.
+
+    :param session: py.test session
+    :return: None
+    """
+    config = session.config
+    if not config.getini('prefetch_module_data'):
+        return
+    if hasattr(config, 'workerinput'):
+        # xdist hands out tests dynamically, so the next module is unknown
+        LOGGER.debug("Module prefetching is disabled on xdist workers")
+        return
+
+    from . import prefetch
+
+    order = []
+    modules = set()
+    nodeids = {}
+    for item in session.items:
+        module = getattr(item, 'module', None)
+        if module is None:
+            continue
+        if module not in nodeids:
+            order.append(module)
+            nodeids[module] = item.getparent(pytest.Module).nodeid
+        # Data for modules whose tests are all skipped would never be used
+        if (hasattr(module, 'module_setup_data') and
+                not _statically_skipped(item)):
+            modules.add(module)
+
+    def create(module):
+        staging = _staging_db(config)
+        result = _setup(module.module_setup_data, staging, config, 'module',
+                        nodeids[module])
+        return staging, result
+
+    config._setup_prefetcher = prefetch.ModulePrefetcher(order, modules,
+                                                         create)
+
+
+def _statically_skipped(item):
+    """
+    Whether the item is skipped by a skip marker, or a skipif marker with
+    a boolean condition, so that none of its fixtures will be set up.
+
+    :param item: py.test test item
+    :return: bool
+    """
+    if item.get_closest_marker('skip'):
+        return True
+    for marker in item.iter_markers('skipif'):
+        conditions = marker.args
+        if 'condition' in marker.kwargs:
+            conditions = (marker.kwargs['condition'],)
+        for condition in conditions:
+            if isinstance(condition, bool) and condition:
+                return True
+    return False
+
+
+def pytest_sessionfinish(session):
+    """
+    py.test hook called when the test session is finished.
+
+    Discards any data prefetched for modules that never ran, or kept for
+    a rerun that never came.
+
+    :param session: py.test session
+    :return: None
+    """
+    prefetcher = getattr(session.config, '_setup_prefetcher', None)
+    if prefetcher:
+        prefetcher.close()
+        session.config._setup_prefetcher = None
+    session.config._setup_rerun_data = None
+
+
+def _staging_db(config):
+    """
+    Creates a TestDataCollection with a private DB, used to hold objects
+    created ahead of time until their module is set up, or kept for a
+    rerun.
+
+    :param config: py.test config module
+    :return: TestDataCollection instance
+    """
+    from . import database
+
+    return database.TestDataCollection(_get_base_representation(config),
+                                       shared=False)
 
 
 @pytest.fixture(scope='module')
@@ -128,12 +397,15 @@ def test_db(request):
     """
     from . import database
 
-    base_representation_class = _get_base_representation(request)
+    base_representation_class = _get_base_representation(request.config)
     tdc = database.TestDataCollection(base_representation_class)
 
     yield tdc
 
-    tdc.clear()
+    cleared = tdc.clear()
+    item_metrics = _metrics(request.config)
+    if item_metrics:
+        item_metrics.cleared += cleared
 
 
 @pytest.fixture(scope='function', autouse=True)
@@ -142,13 +414,57 @@ def clean_test_db(request, test_db):
     This will clear the TestDataCollection from all objects with a ttl of
     'function'.
 
+    If keep_data_on_rerun is enabled, the objects of a failed test are
+    kept aside and put back in the TestDataCollection should the same test
+    be rerun right after, with the module fixtures still set up. If they
+    were set up again, the kept objects may refer to module data that is
+    gone and are discarded.
+
     :param request: py.test request module
     :param test_db: fixture test_db
     :return: None
     """
+    config = request.config
+    kept = getattr(config, '_setup_rerun_data', None)
+    config._setup_rerun_data = None
+    request.node._setup_restored = set()
+    request.node._setup_reusable = {}
+    if kept and kept[0] == request.node.nodeid and kept[1] is test_db:
+        # The rerun makes the same requests, each one takes back one of
+        # the objects created from it in the failed run
+        for record in kept[2].records.values():
+            for key in record.keys:
+                request.node._setup_reusable.setdefault(key, []).append(
+                    record.obj)
+        restored = test_db.merge(kept[2])
+        request.node._setup_restored = set(id(obj) for obj in restored)
+
     yield
 
-    test_db.clear(request.scope)
+    with _timed(request, 'clean_test_db'):
+        item_metrics = _metrics(request.config)
+        if item_metrics:
+            item_metrics.record_size(len(test_db))
+        if _keep_for_rerun(request):
+            kept = _staging_db(config)
+            kept.merge(test_db, request.scope)
+            config._setup_rerun_data = (request.node.nodeid, test_db, kept)
+        cleared = test_db.clear(request.scope)
+        if item_metrics:
+            item_metrics.cleared += cleared
+
+
+def _keep_for_rerun(request):
+    """
+    Whether the function level objects of the current test should be kept
+    for a rerun.
+
+    :param request: py.test request module
+    :return: bool
+    """
+    return (request.config.getini('keep_data_on_rerun') and
+            getattr(request.node, '_setup_call_failed', False) and
+            not request.node.get_closest_marker('recreate_data'))
 
 
 @pytest.fixture(scope='function')
@@ -173,13 +489,15 @@ def user(request, test_db):
     :param test_db: fixture test_db
     :return: None
     """
-    user_data = request.node.get_closest_marker("user")
+    with _timed(request, 'user'):
+        user_data = request.node.get_closest_marker("user")
 
-    if not user_data:
-        return
-    # We must work on a copy of the data or else rerunfailures/flaky fails
-    user_data = user_data.kwargs.copy()
-    _create_user(request, test_db, user_data)
+        if not user_data:
+            return
+        # We must work on a copy of the data or else rerunfailures/flaky
+        # fails
+        user_data = user_data.kwargs.copy()
+        _create_user(request, test_db, user_data)
 
 
 @pytest.fixture(scope="function")
@@ -196,14 +514,16 @@ def users(request, test_db):
     :param test_db: fixture test_db
     :return: None
     """
-    user_data = request.node.get_closest_marker("users")
+    with _timed(request, 'users'):
+        user_data = request.node.get_closest_marker("users")
 
-    if not user_data:
-        return
-    # We must work on a copy of the data or else rerunfailures/flaky fails
-    user_data = tuple(user_data.args)
-    for each in user_data[0]:
-        _create_user(request, test_db, each)
+        if not user_data:
+            return
+        # We must work on a copy of the data or else rerunfailures/flaky
+        # fails
+        user_data = tuple(user_data.args)
+        for each in user_data[0]:
+            _create_user(request, test_db, each)
 
 
 def _create_user(request, test_db, user_data):
@@ -212,10 +532,16 @@ def _create_user(request, test_db, user_data):
     site_index = user_data.pop('site_index', None)
 
     data = [{'User': [user_data]}]
-    _setup(data, test_db, request)
+    _count(request, *_setup(data, test_db, request.config, request.scope,
+                            request.node.nodeid,
+                            request.node._setup_reusable))
 
     _user = test_db.get("User", user_data['name'])
 
+    if id(_user) in request.node._setup_restored:
+        # Kept from the failed run, which already added the memberships
+        return
+
     if account:
         account = test_db.get("Account", account)
         account.add_member(account.owner, _user, site_index=site_index)
@@ -230,18 +556,37 @@ def setup_module(request, test_db):
     """
     Module level object factory.
 
-    This fixture sets up test data with a ttl of 'module'.
+    This fixture sets up test data with a ttl of 'module'. If module
+    prefetching is enabled the data may already have been created in the
+    background, in which case it is only added to the test DB.
 
     :param request: py.test request module
     :param test_db: fixture test_db
     :return: None
     """
-    if hasattr(request.module, 'module_setup_data'):
-        _setup(request.module.module_setup_data, test_db, request)
+    prefetcher = getattr(request.config, '_setup_prefetcher', None)
+
+    try:
+        with _timed(request, 'setup_module'):
+            if hasattr(request.module, 'module_setup_data'):
+                prefetched = None
+                if prefetcher:
+                    prefetched = prefetcher.take(request.module)
+                if prefetched is None:
+                    result = _setup(request.module.module_setup_data,
+                                    test_db, request.config, request.scope,
+                                    request.node.nodeid)
+                else:
+                    staging, result = prefetched
+                    test_db.merge(staging)
+                _count(request, *result)
+    finally:
+        if prefetcher:
+            prefetcher.prefetch_after(request.module)
 
 
 @pytest.fixture(scope='function', autouse=True)
-def setup_function(request, test_db, user, users):
+def setup_function(request, test_db, clean_test_db, user, users):
     """
     Function level object factory.
 
@@ -249,27 +594,48 @@ def setup_function(request, test_db, user, users):
 
     :param request: py.test request module
     :param test_db: fixture test_db
+    :param clean_test_db: fixture clean_test_db, which must run first to
+                            put back objects kept for a rerun
     :return: None
     """
-    setup_data = request.node.get_closest_marker("setup_data")
+    with _timed(request, 'setup_function'):
+        setup_data = request.node.get_closest_marker("setup_data")
 
-    if not setup_data:
-        return
+        if not setup_data:
+            return
+
+        _count(request, *_setup(setup_data.args, test_db, request.config,
+                                request.scope, request.node.nodeid,
+                                request.node._setup_reusable))
 
-    _setup(setup_data.args, test_db, request)
 
+def _count(request, created, reused):
+    item_metrics = _metrics(request.config)
+    if item_metrics:
+        item_metrics.created += len(created)
+        item_metrics.reused += len(reused)
 
-def _setup(test_data, test_db, request):
+
+def _setup(test_data, test_db, config, scope, nodeid=None, reusable=None):
     """
     Setup test data and add to test DB.
 
     :param test_data: test data for object creation
     :param test_db: test DB
+    :param config: py.test config module
     :param scope: ttl for created object(s)
-    :return: None
+    :param nodeid: node id of the test or module creating the object(s)
+    :param reusable: dict of request key and list of objects created from
+                        that request in a failed run of the same test
+    :return: tuple of the list of all objects added to the test DB and the
+                list of objects already in the test DB that were reused
     """
+    budget = getattr(config, '_setup_budget', None)
+    added = []
+    reused = []
+
     def _add():
-        test_db.add(created_obj, request.scope)
+        added.append(test_db.add(created_obj, scope, key, nodeid))
         # This adds objects created within an object creation to the test_db
         try:
             representations = created_obj.default_representations
@@ -277,7 +643,7 @@ def _setup(test_data, test_db, request):
                 raise RuntimeError(
                     "default_representations must return a list!")
             for each in _flatten_list(representations):
-                test_db.add(each, request.scope)
+                added.append(test_db.add(each, scope, nodeid=nodeid))
         except AttributeError as e:
             LOGGER.debug(
                 "Failed to get default_representations "
@@ -286,31 +652,98 @@ def _setup(test_data, test_db, request):
 
     for data in test_data:
         for obj, params in data.items():
-            obj_to_create = _get_representation(obj, request)
+            obj_to_create = _get_representation(obj, config)
             # if params is a list, that means we have multiple objects to
             # create
-            if isinstance(params, list):
-                for sig in params:
-                    # We must work on a copy of the data or else
-                    # rerunfailures/flaky fails
-                    created_obj = _create(obj_to_create, sig.copy(),
-                                          test_db, request)
-                    _add()
-            else:
-                created_obj = _create(obj_to_create, params.copy(),
-                                      test_db, request)
+            if not isinstance(params, list):
+                params = [params]
+            for sig in params:
+                key = _request_key(obj_to_create, sig)
+                existing = _find_existing(obj_to_create, sig, key, test_db,
+                                          scope, reusable)
+                if existing is not None:
+                    reused.append(existing)
+                    continue
+                # We must work on a copy of the data or else
+                # rerunfailures/flaky fails
+                created_obj = _create(obj_to_create, sig.copy(), test_db,
+                                      budget)
                 _add()
+    return added, reused
+
+
+def _request_key(obj_to_create, params):
+    """
+    Key identifying a creation request, equal for requests of the same
+    representation with the same parameters.
+
+    :param obj_to_create: type of representation to create
+    :param params: creation parameters
+    :return: hashable key, or None if the parameters are not hashable
+    """
+    def freeze(value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(freeze(v) for v in value)
+        return value
+
+    key = (obj_to_create.__name__, freeze(params))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _find_existing(obj_to_create, params, key, test_db, scope,
+                   reusable=None):
+    """
+    Find an object in the test DB satisfying a creation request.
+
+    Only requests known to give the same object are resolved: ones kept
+    from a failed run of the same test, ones naming the identifier, if the
+    representation declares which parameter holds it in IDENTIFIER, and
+    ones identical to an earlier request, if the representation sets
+    REUSE_IDENTICAL.
+
+    :param obj_to_create: type of representation to create
+    :param params: creation parameters
+    :param key: key of the request
+    :param test_db: test DB
+    :param scope: ttl of the request
+    :param reusable: dict of request key and list of objects kept from a
+                        failed run of the same test
+    :return: object representation instance, or None if not found
+    """
+    if reusable and reusable.get(key):
+        return reusable[key].pop(0)
+
+    obj = None
+    identifier_param = getattr(obj_to_create, 'IDENTIFIER', None)
+    if identifier_param and params.get(identifier_param) is not None:
+        obj = test_db.get(obj_to_create, params[identifier_param])
+    if obj is None and getattr(obj_to_create, 'REUSE_IDENTICAL', False):
+        obj = test_db.find(key)
+
+    record = test_db.record(obj) if obj is not None else None
+    if record is not None and record.ttl != scope:
+        warnings.warn(
+            "Reusing {} <{}> with ttl '{}' for a request with ttl '{}', "
+            "changes to it are seen by other tests".format(
+                obj_to_create.__name__, obj.identifier, record.ttl, scope))
+    return obj
 
 
 @retry_on_error(IndexError)
-def _create(obj_to_create, test_params, test_db, request):
+def _create(obj_to_create, test_params, test_db, budget=None):
     """
     Create test data object (real object representation).
 
     :param obj_to_create: type of representation to create
     :param test_params: creation parameters
     :param test_db: test DB
-    :param request: py.test request module
+    :param budget: CreationBudget limiting the creation, if any
     :return: instance of created object
     """
 
@@ -340,12 +773,27 @@ def _create(obj_to_create, test_params, test_db, request):
             test_params.pop(object_param, None)
 
     try:
-        return obj_to_create.create(**test_params)
+        return _call_create(obj_to_create, test_params, budget)
     except IndexError:
         # Sometimes we get a 'Failue to persist' which causes a IndexError,
         # so we retry once.
         from time import sleep
         sleep(5)
+        return _call_create(obj_to_create, test_params, budget)
+
+
+def _call_create(obj_to_create, test_params, budget):
+    """
+    Call create on the representation, within the creation budget.
+
+    :param obj_to_create: type of representation to create
+    :param test_params: creation parameters
+    :param budget: CreationBudget limiting the creation, if any
+    :return: instance of created object
+    """
+    if budget is None:
+        return obj_to_create.create(**test_params)
+    with budget.acquire(obj_to_create):
         return obj_to_create.create(**test_params)
 
 
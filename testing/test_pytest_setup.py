@@ -1,9 +1,19 @@
+import json
+import threading
+import time
+from xml.etree import ElementTree
+
 import py
 import pytest
 
 pytest_plugins = 'pytester'
 
 USER_CLASS = """
+import itertools
+import threading
+
+CREATED = []
+
 class BaseUser(object):
     def __init__(self, user_name, identifier):
         self._user_name = user_name
@@ -18,9 +28,11 @@ class BaseUser(object):
         return self._identifier
 
     SIGNATURE = {'name': str}
+    IDENTIFIER = 'name'
 
     @classmethod
     def create(cls, name):
+        CREATED.append((name, threading.current_thread().name))
         return cls(name, name)
 
 class User(BaseUser):
@@ -35,6 +47,30 @@ class User(BaseUser):
 class Owner(BaseUser):
     def __init__(self, user_name, identifier):
         super(Owner, self).__init__(user_name, identifier)
+
+class Account(BaseUser):
+    def __init__(self, user_name, identifier):
+        super(Account, self).__init__(user_name, identifier)
+        self.owner = None
+        self.members = []
+
+    def add_member(self, owner, user, site_index=None):
+        self.members.append(user)
+
+class Project(BaseUser):
+    SIGNATURE = {'size': int}
+    IDENTIFIER = None
+    counter = itertools.count()
+
+    @classmethod
+    def create(cls, size=None):
+        # The backend names the project
+        name = '{}-{}'.format(cls.__name__, next(cls.counter))
+        CREATED.append((name, threading.current_thread().name))
+        return cls(name, name)
+
+class Team(Project):
+    REUSE_IDENTICAL = True
 """
 
 
@@ -48,7 +84,8 @@ def repren(request, testdir):
     """.format(request.function.__name__))
     repr_dir = testdir.mkdir('repr')
     repr_dir.join('__init__.py').write(py.code.Source("""
-        from .user import BaseUser, User, Owner
+        from .user import (BaseUser, User, Owner, Account, Project, Team,
+                           CREATED)
         """))
     repr_dir.join('user.py').write(py.code.Source(USER_CLASS))
     return testdir
@@ -180,7 +217,6 @@ def test_module_scope(repren):
     assert_outcomes(result, passed=2)
 
 
-@pytest.mark.xfail()
 def test_no_duplicates_func(repren):
     repren.makepyfile("""
         import pytest
@@ -193,7 +229,6 @@ def test_no_duplicates_func(repren):
     assert_outcomes(result)
 
 
-@pytest.mark.xfail()
 def test_no_duplicates_module(repren):
     repren.makepyfile("""
         import pytest
@@ -208,7 +243,6 @@ def test_no_duplicates_module(repren):
     assert_outcomes(result)
 
 
-@pytest.mark.xfail()
 def test_no_duplicates_combined(repren):
     repren.makepyfile("""
         import pytest
@@ -250,3 +284,401 @@ def test_test_name(repren):
     """)
     result = repren.runpytest()
     assert_outcomes(result)
+
+
+def test_prefetch_module(repren):
+    repren.makepyfile(test_a="""
+        module_setup_data = [{'User': [{'name': 'Rob'}]}]
+
+        def test_pass(test_db):
+            assert test_db.get('User', 'Rob').identifier == 'Rob'
+            assert test_db.get('User', 'Bob') is None
+    """, test_b="""
+        import threading
+        from test_prefetch_module0.repr import CREATED
+
+        module_setup_data = [{'User': [{'name': 'Bob'}]}]
+
+        def test_pass(test_db):
+            assert test_db.get('User', 'Rob') is None
+            assert test_db.get('User', 'Bob').identifier == 'Bob'
+            record = test_db.record(test_db.get('Owner', 'Bobs Ownah'))
+            assert record.ttl == 'module'
+            assert record.nodeid == 'test_b.py'
+            main = threading.current_thread().name
+            assert dict(CREATED)['Rob'] == main
+            assert dict(CREATED)['Bob'] != main
+    """)
+    result = repren.runpytest('-o', 'prefetch_module_data=true')
+    assert_outcomes(result, passed=2)
+
+
+def test_prefetch_module_deselected(repren):
+    repren.makepyfile(test_a="""
+        module_setup_data = [{'User': [{'name': 'Rob'}]}]
+
+        def test_pass(test_db):
+            pass
+    """, test_b="""
+        module_setup_data = [{'User': [{'name': 'Bob'}]}]
+
+        def test_pass(test_db):
+            pass
+    """, test_c="""
+        from test_prefetch_module_deselected0.repr import CREATED
+
+        module_setup_data = [{'User': [{'name': 'Tim'}]}]
+
+        def test_pass(test_db):
+            assert [name for name, _ in CREATED] == [
+                'Rob', 'Robs Ownah', 'Tim', 'Tims Ownah']
+    """)
+    result = repren.runpytest('-o', 'prefetch_module_data=true',
+                              '--deselect', 'test_b.py::test_pass')
+    assert_outcomes(result, passed=2, deselected=1)
+
+
+def test_creation_rate(repren):
+    repren.makepyfile("""
+        import pytest
+
+        @pytest.mark.setup_data({'User': [{'name': 'Bob'}, {'name': 'Rob'},
+                                          {'name': 'Tim'}, {'name': 'Tom'}]})
+        def test_pass(test_db):
+            assert test_db.get('User', 'Tom').identifier == 'Tom'
+    """)
+    start = time.time()
+    result = repren.runpytest('-o', 'creation_rate=User: 2',
+                              '-o', 'creation_budget_dir={}'.format(
+                                  repren.tmpdir.join('budget')))
+    assert_outcomes(result)
+    # Burst of two, then one creation per half second
+    assert time.time() - start >= 0.9
+
+
+def test_creation_concurrency(tmpdir):
+    from pytest_setup.budget import CreationBudget
+
+    class User(object):
+        pass
+
+    budget = CreationBudget(str(tmpdir), concurrency={'*': 2})
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def create():
+        with budget.acquire(User):
+            with lock:
+                active.append(1)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.pop()
+
+    threads = [threading.Thread(target=create) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) == 2
+
+
+@pytest.mark.parametrize('option, line', [
+    ('creation_concurrency', 'User'),
+    ('creation_concurrency', 'User: 0'),
+    ('creation_concurrency', 'User: -1'),
+    ('creation_rate', 'User: 0'),
+    ('creation_rate', 'User: -2'),
+])
+def test_creation_limit_invalid(repren, option, line):
+    repren.makepyfile("""
+        def test_pass():
+            pass
+    """)
+    result = repren.runpytest('-o', '{}={}'.format(option, line))
+    # Usage error exit code
+    assert result.ret == 4
+    result.stderr.fnmatch_lines([
+        "ERROR: Invalid creation limit <{}>, expected "
+        "'<class name>: <value>' with a value greater than 0".format(line)])
+    assert 'INTERNALERROR' not in result.stdout.str() + result.stderr.str()
+
+
+def test_setup_metrics(repren):
+    repren.makepyfile("""
+        import pytest
+
+        module_setup_data = [{'User': [{'name': 'Rob'}]}]
+
+        @pytest.mark.setup_data({'User': [{'name': 'Bob'}]})
+        def test_pass(test_db):
+            pass
+
+        def test_pass2(test_db):
+            pass
+    """)
+    result = repren.runpytest('-o', 'setup_metrics_log=metrics.jsonl',
+                              '--junitxml=junit.xml')
+    assert_outcomes(result, passed=2)
+
+    first, second = [json.loads(line) for line in
+                     repren.tmpdir.join('metrics.jsonl').readlines()]
+    assert first['nodeid'] == 'test_setup_metrics.py::test_pass'
+    assert first['setup_objects_created'] == 4
+    assert first['setup_objects_cleared'] == 2
+    assert first['setup_test_db_peak_size'] == 4
+    assert first['setup_module_time'] > 0
+    assert second['setup_objects_created'] == 0
+    assert second['setup_objects_cleared'] == 2
+    assert second['setup_module_time'] == 0
+
+    junit = repren.tmpdir.join('junit.xml').read()
+    assert 'name="setup_objects_created" value="4"' in junit
+
+
+def test_no_duplicates_user_marker(repren):
+    repren.makepyfile("""
+        import pytest
+        from test_no_duplicates_user_marker0.repr import CREATED
+
+        @pytest.mark.user(name='Bob')
+        @pytest.mark.setup_data({'User': [{'name': 'Bob'}]})
+        def test_pass(test_db):
+            assert test_db.get('User', 'Bob').identifier == 'Bob'
+            assert [name for name, _ in CREATED] == ['Bob', 'Bobs Ownah']
+    """)
+    result = repren.runpytest('-o', 'setup_metrics_log=metrics.jsonl')
+    assert_outcomes(result)
+    metrics = json.loads(repren.tmpdir.join('metrics.jsonl').read())
+    assert metrics['setup_objects_created'] == 2
+    assert metrics['setup_objects_reused'] == 1
+
+
+RERUN_CONFTEST = """
+from _pytest.runner import runtestprotocol
+
+def pytest_runtest_protocol(item, nextitem):
+    # Minimal stand-in for pytest-rerunfailures, rerunning a failed test once
+    item.ihook.pytest_runtest_logstart(nodeid=item.nodeid,
+                                       location=item.location)
+    reports = runtestprotocol(item, nextitem=nextitem, log=False)
+    if any(report.failed for report in reports):
+        item._initrequest()
+        reports = runtestprotocol(item, nextitem=nextitem, log=False)
+    for report in reports:
+        item.ihook.pytest_runtest_logreport(report=report)
+    return True
+"""
+
+
+@pytest.mark.parametrize('marker, created', [
+    ('', ['Bob', 'Bobs Ownah', 'Project-0', 'Project-1']),
+    ('@pytest.mark.recreate_data',
+     ['Bob', 'Bobs Ownah', 'Project-0', 'Project-1',
+      'Bob', 'Bobs Ownah', 'Project-2', 'Project-3']),
+])
+def test_keep_data_on_rerun(repren, marker, created):
+    repren.makeconftest(RERUN_CONFTEST)
+    repren.makepyfile("""
+        import pytest
+        from test_keep_data_on_rerun0.repr import CREATED
+
+        attempts = []
+
+        {}
+        @pytest.mark.setup_data({{'User': [{{'name': 'Bob'}}]}},
+                                {{'Project': [{{}}, {{}}]}})
+        def test_flaky(test_db):
+            attempts.append(test_db.get('User', 'Bob'))
+            assert test_db.get('Owner', 'Bobs Ownah') is not None
+            assert len(test_db.objects('function')) == 4
+            assert len(attempts) == 2
+
+        def test_after(test_db):
+            assert test_db.get('User', 'Bob') is None
+            assert [name for name, _ in CREATED] == {!r}
+    """.format(marker, created))
+    result = repren.runpytest('-o', 'keep_data_on_rerun=true')
+    assert_outcomes(result, passed=2)
+
+
+def test_slotted_representation():
+    from pytest_setup.database import TestDataCollection
+
+    class Base(object):
+        __slots__ = ()
+
+    class Thing(Base):
+        __slots__ = ('identifier',)
+
+        def __init__(self, identifier):
+            self.identifier = identifier
+
+    tdc = TestDataCollection(Base, shared=False)
+    thing = tdc.add(Thing('lamp'), 'function', ('Thing', 'lamp'), 'test.py')
+    record = tdc.record(thing)
+    assert (record.ttl, record.nodeid, record.categories) == (
+        'function', 'test.py', ('Thing',))
+    assert tdc.find(('Thing', 'lamp')) is thing
+    assert len(tdc) == 1
+
+    assert tdc.clear('function') == 1
+    assert tdc.get('Thing', 'lamp') is None
+    assert tdc.find(('Thing', 'lamp')) is None
+    assert tdc.record(thing) is None
+
+
+def make_skip_modules(testdir, skip_b):
+    modules = {}
+    for name in 'abcd':
+        modules['test_' + name] = """
+            import pytest
+            {}
+            module_setup_data = [{{'User': [{{'name': '{}'}}]}}]
+
+            def test_pass(test_db):
+                assert test_db.get('User', '{}') is not None
+        """.format(skip_b if name == 'b' else '', name, name)
+    modules['test_e'] = """
+        import threading
+        from {}.repr import CREATED
+
+        module_setup_data = [{{'User': [{{'name': 'e'}}]}}]
+
+        def test_pass(test_db):
+            threads = dict(CREATED)
+            main = threading.current_thread().name
+            assert threads['a'] == main
+            assert threads['d'] != main
+            assert threads['e'] != main
+    """.format(testdir.tmpdir.basename)
+    testdir.makepyfile(**modules)
+
+
+def test_prefetch_module_skipped(repren):
+    make_skip_modules(repren, 'pytestmark = pytest.mark.skip')
+    repren.makepyfile(test_f="""
+        import threading
+        from test_prefetch_module_skipped0.repr import CREATED
+
+        def test_pass():
+            threads = dict(CREATED)
+            assert 'b' not in threads
+            assert threads['c'] != threading.current_thread().name
+    """)
+    result = repren.runpytest('-o', 'prefetch_module_data=true')
+    assert_outcomes(result, passed=5, skipped=1)
+
+
+def test_prefetch_module_skipped_at_runtime(repren):
+    # A string condition is only evaluated when the test is set up, so the
+    # data of b is prefetched and has to be passed over
+    make_skip_modules(repren, 'pytestmark = pytest.mark.skipif("True")')
+    result = repren.runpytest('-o', 'prefetch_module_data=true')
+    assert_outcomes(result, passed=4, skipped=1)
+
+
+def test_no_duplicates_generated_identifier(repren):
+    repren.makepyfile("""
+        import pytest
+
+        module_setup_data = [{'Project': [{}]}]
+
+        @pytest.mark.setup_data({'Project': [{}, {}]})
+        def test_pass(test_db):
+            projects = [test_db.get('Project', 'Project-{}'.format(index))
+                        for index in range(3)]
+            assert [test_db.record(project).ttl for project in projects] == [
+                'module', 'function', 'function']
+
+        def test_after(test_db):
+            assert test_db.get('Project', 'Project-0') is not None
+            assert test_db.get('Project', 'Project-1') is None
+    """)
+    result = repren.runpytest()
+    assert_outcomes(result, passed=2)
+
+
+def test_no_duplicates_reuse_identical(repren):
+    repren.makepyfile("""
+        import pytest
+        from test_no_duplicates_reuse_identical0.repr import CREATED
+
+        @pytest.mark.setup_data({'Team': [{'size': 2}, {'size': 2},
+                                          {'size': 3}]})
+        def test_pass(test_db):
+            assert [name for name, _ in CREATED] == ['Team-0', 'Team-1']
+    """)
+    result = repren.runpytest()
+    assert_outcomes(result)
+
+
+def test_no_duplicates_longer_ttl(repren):
+    repren.makepyfile("""
+        import pytest
+
+        module_setup_data = [{'User': [{'name': 'Rob'}]}]
+
+        @pytest.mark.setup_data({'User': [{'name': 'Rob'}]})
+        def test_pass(test_db):
+            assert test_db.record(test_db.get('User', 'Rob')).ttl == 'module'
+    """)
+    result = repren.runpytest()
+    assert_outcomes(result)
+    result.stdout.fnmatch_lines([
+        "*Reusing User <Rob> with ttl 'module' for a request with ttl "
+        "'function', changes to it are seen by other tests"])
+
+
+def test_setup_metrics_on_rerun(repren):
+    repren.makeconftest(RERUN_CONFTEST)
+    repren.makepyfile("""
+        import pytest
+
+        attempts = []
+
+        @pytest.mark.setup_data({'User': [{'name': 'Bob'}]})
+        def test_flaky():
+            attempts.append(None)
+            assert len(attempts) == 2
+
+        def test_after():
+            pass
+    """)
+    result = repren.runpytest('-o', 'keep_data_on_rerun=true',
+                              '-o', 'setup_metrics=true',
+                              '--junitxml=junit.xml')
+    assert_outcomes(result, passed=2)
+    junit = ElementTree.parse(str(repren.tmpdir.join('junit.xml')))
+    testcase = junit.find(".//testcase[@name='test_flaky']")
+    properties = [(prop.get('name'), prop.get('value'))
+                  for prop in testcase.iter('property')]
+    assert [name for name, _ in properties].count(
+        'setup_objects_created') == 1
+    # The values are those of the rerun, which reused the kept data
+    assert ('setup_objects_created', '0') in properties
+    assert ('setup_objects_reused', '1') in properties
+
+
+def test_keep_data_on_rerun_module_torn_down(repren):
+    # The flaky test is the last of its module, so the rerun stand-in tears
+    # the module fixtures down and the module data is created again
+    repren.makeconftest(RERUN_CONFTEST)
+    repren.makepyfile("""
+        import pytest
+
+        module_setup_data = [{'Account': [{'name': 'acme'}]}]
+
+        attempts = []
+
+        @pytest.mark.user(name='Bob', account='acme')
+        def test_flaky(test_db):
+            attempts.append(test_db.get('User', 'Bob'))
+            account = test_db.get('Account', 'acme')
+            assert test_db.get('User', 'Bob') in account.members
+            assert len(attempts) == 2
+            assert attempts[0] is not attempts[1]
+    """)
+    result = repren.runpytest('-o', 'keep_data_on_rerun=true')
+    assert_outcomes(result)